@@ -1,11 +1,176 @@
 import torch
 import math
+import numpy as np
 import genesis as gs
 from genesis.utils.geom import quat_to_xyz, transform_by_quat, inv_quat, transform_quat_by_quat
 
 def gs_rand_float(lower, upper, shape, device):
     return (upper - lower) * torch.rand(size=shape, device=device) + lower
 
+
+# Canonical order of the reward channels produced by _compute_all_rewards.
+REWARD_NAMES = (
+    "tracking_lin_vel",
+    "tracking_ang_vel",
+    "lin_vel_z",
+    "action_rate",
+    "similar_to_default",
+    "base_height",
+    "orientation_stability",
+    "survive",
+    "penalize_hip_aa",
+    "penalize_hip_fe",
+    "penalize_hip_fe_diff",
+    "penalize_knee_fe_left",
+    "penalize_knee_fe_right",
+    "penalize_ankle_height",
+    "gait_regularity",
+    "foot_orientation",
+    "step_height_consistency",
+    "foot_contact_penalty",
+    "foot_contact_switch",
+)
+
+
+def _compute_all_rewards(
+    dof_pos,
+    base_lin_vel,
+    base_ang_vel,
+    base_euler,
+    base_pos,
+    commands,
+    actions,
+    last_actions,
+    ankle_heights,
+    foot_quat_flat,
+    prev_contact,
+    hip_hist,
+    default_dof_pos,
+    hip_aa_indices,
+    hip_fe_indices,
+    knee_fe_indices,
+    sole_normal_local,
+    tracking_sigma_inv: float,
+    deg2rad: float,
+    base_height_target: float,
+    contact_height: float,
+    swing_height_threshold: float,
+):
+    """Compute every reward channel in one fused kernel.
+
+    All per-step reward math lives here so torch.compile can fuse the many
+    tiny elementwise/reduction ops into a handful of kernels instead of ~15
+    separate launches. Returns a [num_envs, len(REWARD_NAMES)] tensor of raw
+    (unscaled) rewards plus the current foot-contact mask (the caller owns
+    the prev_contact buffer update).
+    """
+    num_envs = dof_pos.shape[0]
+    device = dof_pos.device
+
+    # tracking_lin_vel / tracking_ang_vel
+    lin_vel_err = torch.sum((commands[:, :2] - base_lin_vel[:, :2]) ** 2, dim=1)
+    tracking_lin_vel = torch.exp(-lin_vel_err * tracking_sigma_inv)
+    ang_vel_err = (commands[:, 2] - base_ang_vel[:, 2]) ** 2
+    tracking_ang_vel = torch.exp(-ang_vel_err * tracking_sigma_inv)
+
+    lin_vel_z = base_lin_vel[:, 2] ** 2
+    action_rate = torch.sum((last_actions - actions) ** 2, dim=1)
+    base_height = (base_pos[:, 2] - base_height_target) ** 2
+
+    pr = torch.abs(base_euler[:, 1] * deg2rad)
+    rr = torch.abs(base_euler[:, 0] * deg2rad)
+    orientation_stability = pr**2 + rr**2
+
+    survive = torch.ones(num_envs, device=device)
+
+    hip_aa = dof_pos.index_select(1, hip_aa_indices)
+    hip_fe = dof_pos.index_select(1, hip_fe_indices)
+    knee = dof_pos.index_select(1, knee_fe_indices)
+
+    # These dof_pos reductions sit together so the compiler fuses them over
+    # one pass through the joint-position tensor
+    similar_to_default = torch.sum(torch.abs(dof_pos - default_dof_pos), dim=1)
+    penalize_hip_aa = torch.sum(torch.abs(hip_aa), dim=1)
+    penalize_hip_fe = torch.sum(torch.abs(hip_fe), dim=1)
+    penalize_hip_fe_diff = torch.abs(hip_fe[:, 0] - hip_fe[:, 1])
+
+    # Left/right knee deviations share the single knee gather above but stay
+    # separate reward channels
+    penalize_knee_fe_left = torch.relu(0.9 + knee[:, 0])
+    penalize_knee_fe_right = torch.relu(0.9 - knee[:, 1])
+
+    penalize_ankle_height = torch.mean(ankle_heights, dim=1)
+
+    # gait_regularity
+    phase_diff = torch.abs(hip_fe[:, 0] + hip_fe[:, 1])
+    phase_reward = torch.exp(-phase_diff / 0.3)
+    # Direction consistency of successive hip-angle changes, in one pass.
+    # No data-dependent branch: an all-zero (unfilled) history just yields
+    # sign(0)*sign(0)=0 contributions, so no GPU->CPU sync is needed.
+    left_hip_history = hip_hist[:, 0, :]  # (num_envs, 10)
+    hip_changes = torch.diff(left_hip_history, dim=1)  # (num_envs, 9)
+    s = torch.sign(hip_changes)
+    change_consistency = torch.clamp(s[:, :-1] * s[:, 1:], min=0).sum(dim=1) / (hip_changes.shape[1] - 1)
+    periodicity_reward = change_consistency * 0.5
+    gait_regularity = phase_reward + periodicity_reward
+
+    # foot_orientation: flat feet + left/right consistency. The quats arrive
+    # already flat ([num_envs*2, 4] SoA layout) so no reshape is needed;
+    # sole_normal_local doubles as the world-down direction ([0,0,-1]) for
+    # the alignment dot product.
+    world_sole_normal = transform_by_quat(sole_normal_local.expand(foot_quat_flat.shape[0], 3), foot_quat_flat)
+    alignment = torch.sum(world_sole_normal * sole_normal_local, dim=1).view(num_envs, 2)
+    mean_orientation_reward = torch.mean(alignment, dim=1)
+    orientation_diff = torch.abs(alignment[:, 0] - alignment[:, 1])
+    foot_orientation = 0.5 * mean_orientation_reward + 0.05 * (-orientation_diff)
+
+    height_diff = torch.abs(ankle_heights[:, 1] - ankle_heights[:, 0])
+    step_height_consistency = torch.exp(-height_diff / 0.05)
+
+    # foot contact rewards share one boolean contact mask; cheap bitwise ops
+    # replace the repeated bool->float conversions
+    contact = ankle_heights < contact_height  # [N,2] bool
+    contact_count = contact.sum(dim=1)
+    flight = (contact_count == 0).float()
+    one_contact = (contact_count == 1).float()
+    max_swing_h = torch.amax(ankle_heights, dim=1)
+    foot_contact_penalty = flight + one_contact * torch.relu(max_swing_h - swing_height_threshold)
+
+    change = contact ^ prev_contact
+    foot_contact_switch = (change[:, 0] & change[:, 1]).float()
+
+    rewards = torch.stack(
+        [
+            tracking_lin_vel,
+            tracking_ang_vel,
+            lin_vel_z,
+            action_rate,
+            similar_to_default,
+            base_height,
+            orientation_stability,
+            survive,
+            penalize_hip_aa,
+            penalize_hip_fe,
+            penalize_hip_fe_diff,
+            penalize_knee_fe_left,
+            penalize_knee_fe_right,
+            penalize_ankle_height,
+            gait_regularity,
+            foot_orientation,
+            step_height_consistency,
+            foot_contact_penalty,
+            foot_contact_switch,
+        ],
+        dim=1,
+    )
+    return rewards, contact
+
+
+# Compiled variant for the eager step path; manual CUDA-graph capture (see
+# _capture_post_state_graph) records the plain function instead.
+_compute_all_rewards_compiled = torch.compile(_compute_all_rewards, mode="reduce-overhead")
+
+
 class DodoEnv:
     CONTACT_HEIGHT = 0.05           # 低于这个高度视为接触
     SWING_HEIGHT_THRESHOLD = 0.10   # 单脚悬空超过这个高度就视为“hopping”
@@ -38,6 +203,15 @@ class DodoEnv:
         self.obs_scales = obs_cfg.get("obs_scales", {})
         self.reward_scales = reward_cfg.get("reward_scales", {})
 
+        # Derived scalar constants, hoisted out of the per-step path
+        self._resample_steps = int(env_cfg["resampling_time_s"] / self.dt)
+        self._clip_actions = float(env_cfg["clip_actions"])
+        self._action_scale = float(env_cfg["action_scale"])
+        self._tracking_sigma_inv = 1.0 / reward_cfg["tracking_sigma"]
+        self._deg2rad = math.pi / 180.0
+        self._term_pitch = float(env_cfg["termination_if_pitch_greater_than"])
+        self._term_roll = float(env_cfg["termination_if_roll_greater_than"])
+
         # Initialize Genesis scene
         self.scene = gs.Scene(
             sim_options=gs.options.SimOptions(dt=self.dt, substeps=2),
@@ -60,17 +234,20 @@ class DodoEnv:
         # Add plane
         self.scene.add_entity(gs.morphs.Plane(fixed=True))
 
-        # Base init
-        self.base_init_pos = torch.tensor(env_cfg["base_init_pos"], device=self.device)
-        self.base_init_quat = torch.tensor(env_cfg["base_init_quat"], device=self.device)
+        # Base init: build numpy first for the MJCF morph, then upload the
+        # torch copies (avoids device->host syncs on freshly created tensors)
+        base_init_pos_np = np.asarray(env_cfg["base_init_pos"], dtype=np.float32)
+        base_init_quat_np = np.asarray(env_cfg["base_init_quat"], dtype=np.float32)
+        self.base_init_pos = torch.from_numpy(base_init_pos_np).to(self.device)
+        self.base_init_quat = torch.from_numpy(base_init_quat_np).to(self.device)
         self.inv_base_init_quat = inv_quat(self.base_init_quat)
 
         # Load robot MJCF
         self.robot = self.scene.add_entity(
             gs.morphs.MJCF(
                 file="/home/nvidiapc/dodo/Genesis/genesis/assets/urdf/dodo_robot/dodo.xml",
-                pos=self.base_init_pos.cpu().numpy(),
-                quat=self.base_init_quat.cpu().numpy(),
+                pos=base_init_pos_np,
+                quat=base_init_quat_np,
             )
         )
         self.scene.build(n_envs=num_envs)
@@ -92,12 +269,21 @@ class DodoEnv:
             env_cfg["joint_names"].index("Left_KNEE_FE"),
             env_cfg["joint_names"].index("Right_SHIN_FE"),
         ]
+        # Device-resident index tensors so per-step gathers use index_select
+        # instead of re-uploading the Python lists every call
+        self.hip_aa_idx_t = torch.tensor(self.hip_aa_indices, dtype=torch.long, device=self.device)
+        self.hip_fe_idx_t = torch.tensor(self.hip_fe_indices, dtype=torch.long, device=self.device)
+        self.knee_fe_idx_t = torch.tensor(self.knee_fe_indices, dtype=torch.long, device=self.device)
         self.ankle_links = [
             self.robot.get_link("Right_FOOT_FE"),
             self.robot.get_link("Left_FOOT_FE"),
         ]
+        # Local link indices for batched state queries: base first, then both
+        # feet, so one get_links_pos/get_links_quat call covers all of them
+        self._ankle_link_idx = [link.idx_local for link in self.ankle_links]
+        self._state_link_idx = [self.robot.base_link.idx_local] + self._ankle_link_idx
+        # Chronological hip-angle history: slot [..., -1] is the newest sample
         self.hip_angle_history = torch.zeros((self.num_envs, 2, 10), device=self.device)
-        self.history_idx = 0
 
 
         # PD gains
@@ -113,29 +299,52 @@ class DodoEnv:
             dofs_idx_local=self.motors_dof_idx,
         )
 
-        # Prepare reward functions
-        self.reward_functions = {}
-        self.episode_sums = {}
+        # Prepare reward scales; all reward math itself lives in the fused
+        # _compute_all_rewards kernel above.
         for name, scale in self.reward_scales.items():
+            if name not in REWARD_NAMES:
+                raise KeyError(f"unknown reward '{name}' in reward_scales")
             self.reward_scales[name] = scale * self.dt
-            self.reward_functions[name] = getattr(self, f"_reward_{name}")
-            self.episode_sums[name] = torch.zeros((self.num_envs,), device=self.device)
-
 
         # 假设你的 reward_cfg 里没这两项，就在初始化后手动加上：
         self.reward_scales["foot_contact_penalty"] = -1.0 * self.dt     # 负值 scale，惩罚项
         self.reward_scales["foot_contact_switch"]  = +0.5 * self.dt     # 正值 scale，奖励项
 
-        # 并绑定对应函数
-        self.reward_functions["foot_contact_penalty"] = self._reward_foot_contact_penalty
-        self.reward_functions["foot_contact_switch"]  = self._reward_foot_contact_switch
+        # Scale vector aligned with REWARD_NAMES (zero for unused channels),
+        # so scaling + summing is one multiply + one reduction per step.
+        self.reward_names = list(REWARD_NAMES)
+        self._reward_cols = {name: i for i, name in enumerate(self.reward_names)}
+        self._scale_vec = torch.tensor(
+            [self.reward_scales.get(name, 0.0) for name in self.reward_names],
+            device=self.device,
+        )
+        # Episode sums as one [N, num_rewards] matrix: a single add_ per step
+        # instead of one kernel per reward. Only configured rewards get logged.
+        self._episode_sums_mat = torch.zeros((self.num_envs, len(self.reward_names)), device=self.device)
+        self._logged_rewards = list(self.reward_scales.keys())
 
         # 为“上一步接触”做缓存
-        self.prev_contact = torch.zeros((self.num_envs, 2), device=self.device)  # [num_envs, 左/右]
-
-
-
-
+        self.prev_contact = torch.zeros((self.num_envs, 2), device=self.device, dtype=torch.bool)  # [num_envs, 左/右]
+
+        # Optional CUDA-graph capture of the post-physics tensor work. The
+        # Genesis physics step and state getters cannot be captured, so only
+        # the pure-tensor region (_post_state_update) is graphed; capture
+        # happens lazily on the first step once buffers hold real state.
+        self._use_cuda_graph = bool(env_cfg.get("use_cuda_graph", False)) and self.device.type == "cuda"
+        self._post_state_graph = None
+        self._reward_fn = _compute_all_rewards
+        if not self._use_cuda_graph:
+            if env_cfg.get("compile_post_step", True):
+                # Compile the whole post-physics tensor region (termination,
+                # rewards, obs assembly) in one graph; the plain reward kernel
+                # inlines into it, and reduce-overhead mode captures its own
+                # CUDA graphs. The physics step stays outside as an extension
+                # boundary.
+                self._post_state_update = torch.compile(
+                    self._post_state_update, mode="reduce-overhead", fullgraph=True
+                )
+            else:
+                self._reward_fn = _compute_all_rewards_compiled
 
         # Initialize buffers
         self._init_buffers()
@@ -148,11 +357,37 @@ class DodoEnv:
         self.global_gravity = torch.tensor([0.0, 0.0, -1.0], device=self.device).repeat(N, 1)
 
         self.obs_buf = torch.zeros((N, self.num_obs), device=self.device)
+        # Fixed observation layout: step() writes into these slices so the
+        # buffer keeps one stable address (a CUDA-graph requirement) instead
+        # of being reallocated by torch.cat every step.
+        offset = 0
+        self._obs_slices = {}
+        for name, width in (
+            ("ang_vel", 3),
+            ("gravity", 3),
+            ("commands", C),
+            ("dof_pos", A),
+            ("dof_vel", A),
+            ("actions", A),
+        ):
+            self._obs_slices[name] = slice(offset, offset + width)
+            offset += width
+        # Scalar obs scales as floats so assembly skips the dict lookups
+        self._s_ang_vel = float(self.obs_scales["ang_vel"])
+        self._s_dof_pos = float(self.obs_scales["dof_pos"])
+        self._s_dof_vel = float(self.obs_scales["dof_vel"])
         self.rew_buf = torch.zeros((N,), device=self.device)
-        self.reset_buf = torch.ones((N,), device=self.device, dtype=torch.int32)
+        self.reset_buf = torch.ones((N,), device=self.device, dtype=torch.bool)
         self.episode_length_buf = torch.zeros((N,), device=self.device, dtype=torch.int32)
 
         self.commands = torch.zeros((N, C), device=self.device)
+        # Command bounds on device for single batched draws; refreshed when
+        # the command_cfg ranges change (the curriculum in dodo_train rewrites
+        # lin_vel_x_range between stages)
+        self._cmd_ranges = None
+        self._cmd_low = torch.zeros((3,), device=self.device)
+        self._cmd_span = torch.zeros((3,), device=self.device)
+        self._refresh_command_bounds()
         self.commands_scale = torch.tensor([
             self.obs_scales.get("lin_vel", 1.0),
             self.obs_scales.get("lin_vel", 1.0),
@@ -167,30 +402,64 @@ class DodoEnv:
 
         self.base_pos = torch.zeros((N, 3), device=self.device)
         self.base_quat = torch.zeros((N, 4), device=self.device)
+        # World-frame base velocities and ankle states are fetched from
+        # Genesis into these fixed buffers so graph capture sees stable
+        # tensor addresses.
+        self._base_vel_w = torch.zeros((N, 3), device=self.device)
+        self._base_ang_w = torch.zeros((N, 3), device=self.device)
+        # Foot state in flat [N*2] SoA layout; the reward kernel consumes the
+        # flat quats without a reshape, while the [N, 2] views below serve
+        # per-env aggregation and debugging
+        self._foot_quat_flat = torch.zeros((N * 2, 4), device=self.device)
+        self._foot_height_flat = torch.zeros((N * 2,), device=self.device)
+        self.current_ankle_heights = self._foot_height_flat.view(N, 2)
+        self.current_foot_orientations = self._foot_quat_flat.view(N, 2, 4)
 
         self.default_dof_pos = torch.tensor(
             [self.env_cfg["default_joint_angles"][j] for j in self.env_cfg["joint_names"]],
             device=self.device
         )
+        # Sole normal in foot frame; equals world-down, reused for both in
+        # the foot-orientation reward instead of being rebuilt every call
+        self._sole_normal_local = torch.tensor([0.0, 0.0, -1.0], device=self.device)
+        self.last_raw_rewards = torch.zeros((N, len(REWARD_NAMES)), device=self.device)
         self.extras = {"observations": {}}
 
+    def _refresh_command_bounds(self):
+        # Cheap host-side check; only uploads new bounds when a range changed
+        ranges = (
+            tuple(self.command_cfg["lin_vel_x_range"]),
+            tuple(self.command_cfg["lin_vel_y_range"]),
+            tuple(self.command_cfg["ang_vel_range"]),
+        )
+        if ranges != self._cmd_ranges:
+            self._cmd_ranges = ranges
+            low = [r[0] for r in ranges]
+            span = [r[1] - r[0] for r in ranges]
+            self._cmd_low.copy_(torch.tensor(low, dtype=torch.float32))
+            self._cmd_span.copy_(torch.tensor(span, dtype=torch.float32))
+
     def _resample_commands(self, env_ids):
-        # Uniformly sample linear and angular velocity targets
-        self.commands[env_ids, 0] = gs_rand_float(*self.command_cfg["lin_vel_x_range"], (len(env_ids),), self.device)
-        self.commands[env_ids, 1] = gs_rand_float(*self.command_cfg["lin_vel_y_range"], (len(env_ids),), self.device)
-        self.commands[env_ids, 2] = gs_rand_float(*self.command_cfg["ang_vel_range"], (len(env_ids),), self.device)
+        # Uniformly sample all command dims in one batched draw
+        self._refresh_command_bounds()
+        self.commands[env_ids] = self._cmd_low + self._cmd_span * torch.rand(
+            (len(env_ids), 3), device=self.device
+        )
+
+    def _resample_commands_masked(self, mask):
+        # Boolean-mask variant for the per-step path: one batched draw for
+        # every env (cheap RNG) and a where-merge, so shapes stay static and
+        # no .nonzero() device sync is needed
+        new_cmds = self._cmd_low + self._cmd_span * torch.rand((self.num_envs, 3), device=self.device)
+        self.commands.copy_(torch.where(mask.unsqueeze(1), new_cmds, self.commands))
 
     def reset_idx(self, env_ids):
         if len(env_ids) == 0:
             return
         # Reset joint positions & velocities
 
-        if hasattr(self, "current_ankle_heights"):
-            h = self.current_ankle_heights[env_ids]   # 只取这些 env 的高度
-        else:
-            h = torch.zeros((len(env_ids), 2), device=self.device)
-        contact_init = (h < self.CONTACT_HEIGHT).float()
-        self.prev_contact[env_ids] = contact_init
+        h = self.current_ankle_heights[env_ids]   # 只取这些 env 的高度
+        self.prev_contact[env_ids] = h < self.CONTACT_HEIGHT
         
 
 
@@ -217,101 +486,158 @@ class DodoEnv:
         self.episode_length_buf[env_ids] = 0
         self.reset_buf[env_ids] = True
 
-        # Log episode rewards
-        self.extras["episode"] = {}
-        for name in self.episode_sums:
-            avg = torch.mean(self.episode_sums[name][env_ids]).item() / self.env_cfg["episode_length_s"]
-            self.extras["episode"][f"rew_{name}"] = avg
-            self.episode_sums[name][env_ids] = 0.0
+        # Log episode rewards: one row-mean over the sums matrix and a single
+        # host transfer for all rewards
+        means = (self._episode_sums_mat[env_ids].mean(dim=0) / self.env_cfg["episode_length_s"]).cpu().tolist()
+        self.extras["episode"] = {
+            f"rew_{name}": means[self._reward_cols[name]] for name in self._logged_rewards
+        }
+        self._episode_sums_mat[env_ids] = 0.0
 
         # New commands
         self._resample_commands(env_ids)
 
     def reset(self):
-        self.reset_buf[:] = 1
+        self.reset_buf[:] = True
         self.reset_idx(torch.arange(self.num_envs, device=self.device))
         return self.obs_buf, None
 
     def step(self, actions):
-        # Clip actions
-        self.actions = torch.clip(actions, -self.env_cfg["clip_actions"], self.env_cfg["clip_actions"])
+        # Clip actions into a fixed buffer (stable address for graph capture)
+        torch.clip(actions, -self._clip_actions, self._clip_actions, out=self.actions)
         # Latency
         exec_actions = self.last_actions if self.simulate_action_latency else self.actions
         # Position target
-        target_pos = exec_actions * self.env_cfg["action_scale"] + self.default_dof_pos
+        target_pos = exec_actions * self._action_scale + self.default_dof_pos
         self.robot.control_dofs_position(target_pos, self.motors_dof_idx)
-        
-        # Step sim
+
+        # Step sim (not capturable: Genesis/Taichi kernels)
         self.scene.step()
-        heights = []
-        foot_orientations = []
-        for link in self.ankle_links:
-            pos = link.get_pos()        # shape: (num_envs, 3)
-            heights.append(pos[:, 2])
-            foot_quat = link.get_quat()  # shape: (num_envs, 4)
-            foot_orientations.append(foot_quat)
-        
-        self.current_ankle_heights = torch.stack(heights, dim=1)
-        self.current_foot_orientations = torch.stack(foot_orientations, dim=1)  # shape: (num_envs, 2, 4)
+        self._fetch_state()
 
-        # Time and pose updates
         self.episode_length_buf += 1
-        self.base_pos[:] = self.robot.get_pos()
-        self.base_quat[:] = self.robot.get_quat()
-        # Euler angles in degrees
-        base_rel_quat = transform_quat_by_quat(torch.ones_like(self.base_quat)*self.inv_base_init_quat, self.base_quat)
-        self.base_euler = quat_to_xyz(base_rel_quat, rpy=True, degrees=True)
-        # Velocities in base frame
-        inv_q = inv_quat(self.base_quat)
-        self.base_lin_vel[:] = transform_by_quat(self.robot.get_vel(), inv_q)
-        self.base_ang_vel[:] = transform_by_quat(self.robot.get_ang(), inv_q)
-        self.projected_gravity[:]= transform_by_quat(self.global_gravity, inv_q)
-        self.dof_pos[:] = self.robot.get_dofs_position(self.motors_dof_idx)
-        self.dof_vel[:] = self.robot.get_dofs_velocity(self.motors_dof_idx)
 
-        current_hip_angles = torch.stack([
-            self.dof_pos[:, self.hip_fe_indices[0]],
-            self.dof_pos[:, self.hip_fe_indices[1]]
-        ], dim=1)
+        current_hip_angles = self.dof_pos.index_select(1, self.hip_fe_idx_t)
+
+        # Shift the history left and append the newest sample, keeping the
+        # buffer chronological (the old ring indexing handed torch.diff a
+        # wrapped ordering whenever the write index was mid-buffer) and its
+        # address stable for the reward kernel.
+        self.hip_angle_history.copy_(torch.roll(self.hip_angle_history, shifts=-1, dims=2))
+        self.hip_angle_history[:, :, -1] = current_hip_angles
+
+        # Pure-tensor post-processing: resampling, termination, rewards, observations
+        self._refresh_command_bounds()
+        if self._use_cuda_graph:
+            if self._post_state_graph is None:
+                self._capture_post_state_graph()
+            self._post_state_graph.replay()
+        else:
+            self._post_state_update()
 
-        self.hip_angle_history[:, :, self.history_idx] = current_hip_angles
-        self.history_idx = (self.history_idx + 1) % 10
+        self.extras["observations"]["critic"] = self.obs_buf
+        # Reset environments
+        self.reset_idx(self.reset_buf.nonzero(as_tuple=False).flatten())
+        return self.obs_buf, self.rew_buf, self.reset_buf, self.extras
 
-        # Resample commands
-        idx = (self.episode_length_buf % int(self.env_cfg["resampling_time_s"] / self.dt)==0).nonzero(as_tuple=False).flatten()
-        self._resample_commands(idx)
+    def _fetch_state(self):
+        """Pull the post-physics state from Genesis into fixed buffers."""
+        # Tensorized link states: base + both ankles in one batched query per
+        # quantity instead of separate base getters and per-link calls
+        link_pos = self.robot.get_links_pos(self._state_link_idx)    # (num_envs, 3, 3)
+        link_quat = self.robot.get_links_quat(self._state_link_idx)  # (num_envs, 3, 4)
+        self.base_pos[:] = link_pos[:, 0]
+        self.base_quat[:] = link_quat[:, 0]
+        self.current_ankle_heights[:] = link_pos[:, 1:, 2]
+        self.current_foot_orientations[:] = link_quat[:, 1:]
+
+        self._base_vel_w[:] = self.robot.get_vel()
+        self._base_ang_w[:] = self.robot.get_ang()
+        self.dof_pos[:] = self.robot.get_dofs_position(self.motors_dof_idx)
+        self.dof_vel[:] = self.robot.get_dofs_velocity(self.motors_dof_idx)
+
+    def _capture_post_state_graph(self):
+        """Warm up on a side stream, then record _post_state_update once."""
+        s = torch.cuda.Stream()
+        s.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(s):
+            for _ in range(3):
+                self._post_state_update()
+        torch.cuda.current_stream().wait_stream(s)
+
+        self._post_state_graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self._post_state_graph):
+            self._post_state_update()
+
+    def _post_state_update(self):
+        # Resample commands for envs whose resample period elapsed
+        self._resample_commands_masked(self.episode_length_buf % self._resample_steps == 0)
+
+        # Euler angles in degrees (broadcast the init quat, no ones_like allocation)
+        base_rel_quat = transform_quat_by_quat(
+            self.inv_base_init_quat.unsqueeze(0).expand(self.num_envs, 4), self.base_quat
+        )
+        self.base_euler = quat_to_xyz(base_rel_quat, rpy=True, degrees=True)
+        # Rotate lin vel / ang vel / gravity into the base frame with a single
+        # batched quaternion transform instead of three separate launches.
+        inv_q = inv_quat(self.base_quat)
+        world_vecs = torch.stack([self._base_vel_w, self._base_ang_w, self.global_gravity], dim=1)  # [N,3,3]
+        base_vecs = transform_by_quat(world_vecs, inv_q.unsqueeze(1).expand(-1, 3, 4))
+        self.base_lin_vel[:] = base_vecs[:, 0]
+        self.base_ang_vel[:] = base_vecs[:, 1]
+        self.projected_gravity[:] = base_vecs[:, 2]
 
         # Terminate if out of bounds or timeout
         done = self.episode_length_buf > self.max_episode_length
-        done |= torch.abs(self.base_euler[:,1]) > self.env_cfg["termination_if_pitch_greater_than"]
-        done |= torch.abs(self.base_euler[:,0]) > self.env_cfg["termination_if_roll_greater_than"]
+        done |= torch.abs(self.base_euler[:,1]) > self._term_pitch
+        done |= torch.abs(self.base_euler[:,0]) > self._term_roll
         self.reset_buf = done
 
-        # Reward computation
-        self.rew_buf[:] = 0
-        for name, fn in self.reward_functions.items():
-            r = fn() * self.reward_scales[name]
-            self.rew_buf += r
-            self.episode_sums[name] += r
-
-        # Observation assembly
-        self.obs_buf = torch.cat([
-            self.base_ang_vel * self.obs_scales["ang_vel"],
-            self.projected_gravity,
-            self.commands * self.commands_scale,
-            (self.dof_pos - self.default_dof_pos)*self.obs_scales["dof_pos"],
-            self.dof_vel * self.obs_scales["dof_vel"],
-            self.actions
-        ], dim=-1)
+        # Reward computation: one fused kernel, one scale multiply, one reduction
+        raw_rewards, contact = self._reward_fn(
+            self.dof_pos,
+            self.base_lin_vel,
+            self.base_ang_vel,
+            self.base_euler,
+            self.base_pos,
+            self.commands,
+            self.actions,
+            self.last_actions,
+            self.current_ankle_heights,
+            self._foot_quat_flat,
+            self.prev_contact,
+            self.hip_angle_history,
+            self.default_dof_pos,
+            self.hip_aa_idx_t,
+            self.hip_fe_idx_t,
+            self.knee_fe_idx_t,
+            self._sole_normal_local,
+            self._tracking_sigma_inv,
+            self._deg2rad,
+            self.reward_cfg["base_height_target"],
+            self.CONTACT_HEIGHT,
+            self.SWING_HEIGHT_THRESHOLD,
+        )
+        scaled_rewards = raw_rewards * self._scale_vec
+        self.rew_buf = scaled_rewards.sum(dim=-1)
+        self._episode_sums_mat.add_(scaled_rewards)
+        self.prev_contact[:] = contact
+        self.last_raw_rewards = raw_rewards
+
+        # Observation assembly: scale directly into the buffer slices with
+        # out=, so no intermediate scaled tensors are allocated
+        torch.mul(self.base_ang_vel, self._s_ang_vel, out=self.obs_buf[:, self._obs_slices["ang_vel"]])
+        self.obs_buf[:, self._obs_slices["gravity"]].copy_(self.projected_gravity)
+        torch.mul(self.commands, self.commands_scale, out=self.obs_buf[:, self._obs_slices["commands"]])
+        dof_pos_obs = self.obs_buf[:, self._obs_slices["dof_pos"]]
+        torch.sub(self.dof_pos, self.default_dof_pos, out=dof_pos_obs)
+        dof_pos_obs.mul_(self._s_dof_pos)
+        torch.mul(self.dof_vel, self._s_dof_vel, out=self.obs_buf[:, self._obs_slices["dof_vel"]])
+        self.obs_buf[:, self._obs_slices["actions"]].copy_(self.actions)
 
         self.last_actions[:] = self.actions
         self.last_dof_vel[:] = self.dof_vel
 
-        self.extras["observations"]["critic"] = self.obs_buf
-        # Reset environments
-        self.reset_idx(self.reset_buf.nonzero(as_tuple=False).flatten())
-        return self.obs_buf, self.rew_buf, self.reset_buf, self.extras
-    
     def get_observations(self):
         """
         Returns the current observation buffer and extras dict.
@@ -327,203 +653,3 @@ class DodoEnv:
         Otherwise just return None.
         """
         return None
-
-    # Reward functions
-    def _reward_tracking_lin_vel(self):
-        err = torch.sum((self.commands[:,:2] - self.base_lin_vel[:,:2])**2, dim=1)
-        return torch.exp(-err / self.reward_cfg["tracking_sigma"])
-
-    def _reward_tracking_ang_vel(self):
-        err = (self.commands[:,2] - self.base_ang_vel[:,2])**2
-        return torch.exp(-err / self.reward_cfg["tracking_sigma"])
-
-    def _reward_lin_vel_z(self):
-        return self.base_lin_vel[:,2]**2
-
-    def _reward_action_rate(self):
-        return torch.sum((self.last_actions - self.actions)**2, dim=1)
-
-    def _reward_similar_to_default(self):
-        return torch.sum(torch.abs(self.dof_pos - self.default_dof_pos), dim=1)
-
-    def _reward_base_height(self):
-        return (self.base_pos[:,2] - self.reward_cfg["base_height_target"])**2
-
-    def _reward_orientation_stability(self):
-        pr = torch.abs(self.base_euler[:,1] * math.pi/180)
-        rr = torch.abs(self.base_euler[:,0] * math.pi/180)
-        return pr**2 + rr**2
-
-    def _reward_survive(self):
-        return torch.ones(self.num_envs, device=self.device)
-    
-    def _reward_penalize_hip_aa(self):
-        # self.dof_pos 的 shape 是 [num_envs, num_actions]
-
-        return torch.sum(torch.abs(self.dof_pos[:, self.hip_aa_indices]), dim=1)
-    def _reward_penalize_hip_fe(self):
-        # self.dof_pos 的 shape 是 [num_envs, num_actions]
-
-        return torch.sum(torch.abs(self.dof_pos[:, self.hip_fe_indices]), dim=1)
-    def _reward_penalize_hip_fe_diff(self):
-        # peanlize the difference between left and right hip fe absolute value
-        return torch.abs(self.dof_pos[:, self.hip_fe_indices[0]] - self.dof_pos[:, self.hip_fe_indices[1]])
-    # def _reward_penalize_knee_fe(self):
-    #     # Penalize Right_SHIN_FE if > +0.9, and Left_KNEE_FE if < -0.9. No penalty otherwise.
-    #     # self.dof_pos shape: [num_envs, num_actions]
-    #     pos = self.dof_pos[:, self.knee_fe_indices]
-    #     left_knee = pos[:, 0]   # Left_KNEE_FE
-    #     right_shin = pos[:, 1]  # Right_SHIN_FE
-
-    #     # For Left_KNEE_FE, penalize if below -0.9: deviation = relu(-0.9 - angle)
-    #     left_dev = torch.relu(0.9 + left_knee)
-    #     # For Right_SHIN_FE, penalize if above +0.9: deviation = relu(angle - 0.9)
-    #     right_dev = torch.relu(-right_shin+0.9)
-
-    #     return left_dev + right_dev
-    
-    def _reward_penalize_knee_fe_left(self):
-        pos = self.dof_pos[:, self.knee_fe_indices]
-        left_knee = pos[:, 0]   # Left_KNEE_FE
-        left_dev = torch.relu(0.9 + left_knee)
-        return left_dev
-    def _reward_penalize_knee_fe_right(self):
-        pos = self.dof_pos[:, self.knee_fe_indices]
-        right_shin = pos[:, 1]
-        right_dev = torch.relu(-right_shin + 0.9)
-        return right_dev
-
-
-    def _reward_penalize_ankle_height(self):
-        return torch.mean(self.current_ankle_heights, dim=1)
-    
-    def _reward_gait_regularity(self):
-
-        left_hip = self.dof_pos[:, self.hip_fe_indices[0]]   
-        right_hip = self.dof_pos[:, self.hip_fe_indices[1]]  
-        
-        phase_diff = torch.abs(left_hip + right_hip) 
-        phase_reward = torch.exp(-phase_diff / 0.3)   
-        
-        if torch.sum(self.hip_angle_history) != 0: 
-            left_hip_history = self.hip_angle_history[:, 0, :]  # (num_envs, 10)
-            
-            hip_changes = torch.diff(left_hip_history, dim=1)  # (num_envs, 9)
-            
-            change_consistency = torch.zeros(self.num_envs, device=self.device)
-            for i in range(hip_changes.shape[1] - 1):
-
-                direction_consistency = torch.sign(hip_changes[:, i]) * torch.sign(hip_changes[:, i+1])
-                change_consistency += torch.clamp(direction_consistency, min=0)
-            
-            change_consistency = change_consistency / (hip_changes.shape[1] - 1)
-            periodicity_reward = change_consistency * 0.5  
-        else:
-            periodicity_reward = torch.zeros(self.num_envs, device=self.device)
-        
-        total_gait_reward = phase_reward + periodicity_reward
-        
-        return total_gait_reward
-
-    def _reward_foot_orientation(self):
-        """
-        Reward function for foot orientation with two components:
-        1. Individual foot orientation (rewards flat feet, penalizes tilted feet)
-        2. Foot orientation consistency (penalizes different orientations between feet)
-        """
-        orientation_rewards = []
-        
-        # Use -z axis as sole normal (update based on your debug output)
-        sole_normal_local = torch.tensor([0., 0., -1.], device=self.device)
-        world_down = torch.tensor([0., 0., -1.], device=self.device)
-        
-        foot_alignments = []  # Store individual foot alignments for consistency check
-        
-        for i in range(len(self.ankle_links)):
-            foot_quat = self.current_foot_orientations[:, i, :]  # (num_envs, 4)
-            
-            # Transform sole normal to world coordinates
-            world_sole_normal = transform_by_quat(
-                sole_normal_local.expand(self.num_envs, 3), 
-                foot_quat
-            )
-            
-            # Calculate alignment with world down direction
-            # REMOVED clamp(min=0.0) to allow negative values (penalties)
-            alignment = torch.sum(world_sole_normal * world_down.expand_as(world_sole_normal), dim=1)
-            
-            orientation_rewards.append(alignment)
-            foot_alignments.append(alignment)
-        
-        # Component 1: Mean orientation reward (can be negative for penalty)
-        mean_orientation_reward = torch.mean(torch.stack(orientation_rewards, dim=1), dim=1)
-        
-        # Component 2: Foot orientation consistency penalty
-        # Penalize when the two feet have different orientations
-        if len(foot_alignments) >= 2:
-            left_foot_alignment = foot_alignments[0]   # First foot
-            right_foot_alignment = foot_alignments[1]  # Second foot
-            
-            # Calculate absolute difference in orientations
-            orientation_diff = torch.abs(left_foot_alignment - right_foot_alignment)
-            
-            # Convert to penalty (negative reward for differences)
-            consistency_penalty = -orientation_diff
-            
-            # Combine: 0.5 * orientation_reward + 0.5 * consistency_penalty
-            total_reward = 0.5 * mean_orientation_reward + 0.05 * consistency_penalty
-        else:
-            # If only one foot, just use orientation reward
-            total_reward = mean_orientation_reward
-        
-        return total_reward
-        
-    def _reward_step_height_consistency(self):
-
-        left_height = self.current_ankle_heights[:, 1]   
-        right_height = self.current_ankle_heights[:, 0]  
-        
-        height_diff = torch.abs(left_height - right_height)
-        
-        consistency_reward = torch.exp(-height_diff / 0.05) 
-        
-        return consistency_reward
-    
-    def _reward_foot_contact_penalty(self):
-        """
-        惩罚项：当出现单腿承重且摆动腿抬得太高，或者出现双脚都不着地的“飞行”阶段时给出 penalty。
-        """
-        h = self.current_ankle_heights      # [N, 2]
-        contact = (h < self.CONTACT_HEIGHT).float()   # [N,2] 0/1
-
-        # 1) 双脚都不接触（飞行阶段）：contact.sum==0
-        flight = (contact.sum(dim=1) == 0).float()
-
-        # 2) 单脚承重且摆动腿抬得太高：contact.sum==1 且 max_height > SWING_HEIGHT_THRESHOLD
-        one_contact = (contact.sum(dim=1) == 1).float()
-        max_swing_h = torch.max(h, dim=1)[0]  # 取两只脚最高高度
-        swing_hopping = one_contact * torch.relu(max_swing_h - self.SWING_HEIGHT_THRESHOLD)
-
-        return flight + swing_hopping
-
-
-    def _reward_foot_contact_switch(self):
-        """
-        奖励项：鼓励左右脚交替着地（contact 状态翻转）。
-        只要本步左右脚同时发生翻转，就给 reward=1，否则 0。
-        """
-        h = self.current_ankle_heights
-        contact = (h < self.CONTACT_HEIGHT).float()  # [N,2]
-
-        # 本步每条腿的 contact 状态是否跟上一步不同
-        change = (contact != self.prev_contact).float()  # [N,2]
-
-        # 只有当左右都翻转（contact 状态同时变化）才算一次完整的交替
-        both_changed = (change[:,0] * change[:,1])
-
-        # 更新缓存
-        self.prev_contact[:] = contact
-
-        return both_changed
-
-
@@ -88,23 +88,16 @@ def print_reward_values(env, step):
     print(f"\n--- STEP {step} REWARD VALUES ---")
     
     total_reward = 0.0
-    
-    # Calculate each reward component
+
+    # Reward math lives in the fused kernel; read the raw values cached by the last step()
     for reward_name, scale in env.reward_scales.items():
-        if hasattr(env, f'_reward_{reward_name}'):
-            reward_fn = getattr(env, f'_reward_{reward_name}')
-            raw_reward = reward_fn()
-            scaled_reward = raw_reward * scale
-            
-            if torch.is_tensor(raw_reward):
-                raw_val = raw_reward[0].item() if raw_reward.dim() > 0 else raw_reward.item()
-                scaled_val = scaled_reward[0].item() if scaled_reward.dim() > 0 else scaled_reward.item()
-            else:
-                raw_val = raw_reward
-                scaled_val = scaled_reward
-            
+        col = env._reward_cols.get(reward_name)
+        if col is not None:
+            raw_val = env.last_raw_rewards[0, col].item()
+            scaled_val = raw_val * scale
+
             total_reward += scaled_val
-            
+
             print(f"  {reward_name:25s}: raw={raw_val:+8.4f}, scale={scale:+8.4f}, scaled={scaled_val:+8.4f}")
     
     print(f"  {'TOTAL_REWARD':25s}: {total_reward:+8.4f}")